@@ -1,28 +1,80 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import declarative_base, sessionmaker
+from asyncio import current_task
+
+from sqlalchemy import event, inspect
+from sqlalchemy.ext.asyncio import async_scoped_session, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import declarative_base
 
 DATABASE_NAME = "sns_api.db"
-SQLALCHEMY_DATABASE_URL = f"sqlite:///./{DATABASE_NAME}"
+SQLALCHEMY_DATABASE_URL = f"sqlite+aiosqlite:///./{DATABASE_NAME}"
 
-engine = create_engine(
+engine = create_async_engine(
     SQLALCHEMY_DATABASE_URL, 
-    connect_args={"check_same_thread": False}
+    connect_args={"check_same_thread": False, "timeout": 30},
+    pool_size=20,
+    max_overflow=10,
+    pool_timeout=30,
+    pool_recycle=3600,
+    pool_pre_ping=True,
+    query_cache_size=1200
 )
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+@event.listens_for(engine.sync_engine, "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    """Enable foreign key enforcement, and WAL so readers don't block on the writer."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
+# One session per request task, released by SessionCleanupMiddleware
+SessionLocal = async_scoped_session(
+    async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False),
+    scopefunc=current_task
+)
 
 Base = declarative_base()
 
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+async def get_db():
+    return SessionLocal()
+
+
+class SessionCleanupMiddleware:
+    """Close the request's scoped session once the response has been sent."""
 
+    # Plain ASGI rather than @app.middleware("http"), which would run the endpoint
+    # in a different task and so see a different session scope.
+    def __init__(self, app):
+        self.app = app
 
-def init_db():
+    async def __call__(self, scope, receive, send):
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            if scope["type"] == "http":
+                await SessionLocal.remove()
+
+
+async def init_db():
     """Initialize the database by creating all tables."""
     from models import Post, Comment, Like
-    Base.metadata.create_all(bind=engine)
+    async with engine.begin() as conn:
+        await conn.run_sync(_create_schema)
+
+
+def _create_schema(conn):
+    """Create the tables on a fresh database; otherwise only add missing indexes."""
+    if not inspect(conn).has_table("posts"):
+        Base.metadata.create_all(conn)
+    else:
+        _create_missing_indexes(conn)
+
+
+def _create_missing_indexes(conn):
+    """Add indexes declared after a table was first created; create_all skips existing tables."""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
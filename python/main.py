@@ -1,30 +1,81 @@
-from datetime import datetime
+import json
+import os
+import tempfile
 from typing import Annotated
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, Depends, HTTPException, status, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
-from sqlalchemy.orm import Session
+from sqlalchemy import case, delete, insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import raiseload
 from sqlalchemy.exc import IntegrityError
+from pydantic import TypeAdapter
 import yaml
 
-from database import get_db, init_db
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+from database import SessionCleanupMiddleware, get_db, init_db
 from models import Post as DBPost, Comment as DBComment, Like as DBLike
 from schemas import (
     Post, NewPost, UpdatePost,
     Comment, NewComment, UpdateComment,
-    LikeRequest, ErrorResponse
+    LikeRequest
 )
 
+OPENAPI_YAML_PATH = "../openapi.yaml"
+OPENAPI_CACHE_PATH = "../openapi.json"
+
+
+def load_openapi_spec():
+    """Load the OpenAPI spec, reusing the JSON cache while it is newer than the YAML."""
+    try:
+        if os.path.getmtime(OPENAPI_CACHE_PATH) >= os.path.getmtime(OPENAPI_YAML_PATH):
+            with open(OPENAPI_CACHE_PATH, "rb") as f:
+                return json_loads(f.read())
+    except (OSError, ValueError):
+        pass
+
+    with open(OPENAPI_YAML_PATH, "r") as f:
+        spec = yaml.load(f, Loader=SafeLoader)
+
+    # YAML dates and other non-JSON scalars are stored as strings, and the returned spec
+    # comes from the same JSON so cold and cached starts serve identical data
+    data = json.dumps(spec, default=str)
+
+    # Write to a temp file and swap it in so other workers never read a partial cache
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(OPENAPI_CACHE_PATH), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(data)
+            # mkstemp creates the file owner-only; let workers running as other users read it
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, OPENAPI_CACHE_PATH)
+        except OSError:
+            os.unlink(tmp_path)
+            raise
+    except OSError:
+        pass
+    return json_loads(data)
+
+
 # Load OpenAPI specification
-with open("../openapi.yaml", "r") as f:
-    openapi_spec = yaml.safe_load(f)
+openapi_spec = load_openapi_spec()
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
-    init_db()
+    await init_db()
     yield
     # Shutdown (if needed)
 
@@ -49,53 +100,55 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Release each request's database session
+app.add_middleware(SessionCleanupMiddleware)
+
 # Database dependency
-DBSession = Annotated[Session, Depends(get_db)]
+DBSession = Annotated[AsyncSession, Depends(get_db)]
 
 
 # Custom OpenAPI schema to match the spec exactly
-def custom_openapi():
-    if app.openapi_schema:
-        return app.openapi_schema
-    
-    # Use the loaded OpenAPI spec but update paths to include /api prefix
-    openapi_schema = openapi_spec.copy()
-    
-    # Add the actual routes from the app
-    from fastapi.openapi.utils import get_openapi
-    generated = get_openapi(
-        title=app.title,
-        version=app.version,
-        description=app.description,
-        routes=app.routes,
-    )
-    
-    # Use the paths from our openapi.yaml
-    openapi_schema["paths"] = openapi_spec["paths"]
-    openapi_schema["components"] = openapi_spec["components"]
-    openapi_schema["tags"] = openapi_spec.get("tags", [])
-    openapi_schema["servers"] = [{"url": "http://localhost:8000/api", "description": "Local development server"}]
-    openapi_schema["openapi"] = "3.0.1"
-    
-    app.openapi_schema = openapi_schema
-    return app.openapi_schema
+OPENAPI_SCHEMA = {
+    **openapi_spec,
+    "tags": openapi_spec.get("tags", []),
+    "servers": [{"url": "http://localhost:8000/api", "description": "Local development server"}],
+    "openapi": "3.0.1",
+}
+
+app.openapi = lambda: OPENAPI_SCHEMA
+
+
+# Shared error payloads
+POST_NOT_FOUND = {"code": "NOT_FOUND", "message": "Post not found"}
+COMMENT_NOT_FOUND = {"code": "NOT_FOUND", "message": "Comment not found"}
+INVALID_FIELDS = {"code": "BAD_REQUEST", "message": "Invalid input for required fields."}
+INVALID_USERNAME = {"code": "BAD_REQUEST", "message": "Invalid input for required field 'username'."}
 
 
-app.openapi = custom_openapi
+# Prebuilt serializers for list responses
+POSTS_ADAPTER = TypeAdapter(list[Post])
+COMMENTS_ADAPTER = TypeAdapter(list[Comment])
+
+
+# Helper function to serialize ORM rows straight to a JSON response,
+# bypassing FastAPI's per-call response_model handling
+def json_list_response(adapter: TypeAdapter, rows):
+    items = adapter.validate_python(rows, from_attributes=True)
+    return Response(content=adapter.dump_json(items), media_type="application/json")
 
 
 # Helper function to create error response
 def error_response(code: str, message: str, status_code: int, details: dict = None):
     return JSONResponse(
         status_code=status_code,
-        content=ErrorResponse(code=code, message=message, details=details).model_dump(exclude_none=True)
+        content={"code": code, "message": message} | ({"details": details} if details else {})
     )
 
 
 # ==================== ROOT ENDPOINT ====================
 
 @app.get("/")
-def root():
+async def root():
     """Root endpoint - redirects to API documentation."""
     from fastapi.responses import RedirectResponse
     return RedirectResponse(url="/api/docs")
@@ -104,11 +157,12 @@ def root():
 # ==================== POST ENDPOINTS ====================
 
 @app.get("/api/posts", response_model=list[Post], tags=["Posts"])
-def list_posts(db: DBSession):
+async def list_posts(db: DBSession):
     """List all posts."""
     try:
-        posts = db.query(DBPost).all()
-        return posts
+        # Post responses don't include comments or likes, so never lazy-load them
+        posts = (await db.scalars(select(DBPost).options(raiseload("*")))).all()
+        return json_list_response(POSTS_ADAPTER, posts)
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -117,25 +171,24 @@ def list_posts(db: DBSession):
 
 
 @app.post("/api/posts", response_model=Post, status_code=status.HTTP_201_CREATED, tags=["Posts"])
-def create_post(post: NewPost, db: DBSession):
+async def create_post(post: NewPost, db: DBSession):
     """Create a new post."""
     if not post.username or not post.content:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail={"code": "BAD_REQUEST", "message": "Invalid input for required fields."}
+            detail=INVALID_FIELDS
         )
     
     try:
-        db_post = DBPost(
-            username=post.username,
-            content=post.content
+        db_post = await db.scalar(
+            insert(DBPost)
+            .values(username=post.username, content=post.content)
+            .returning(DBPost)
         )
-        db.add(db_post)
-        db.commit()
-        db.refresh(db_post)
+        await db.commit()
         return db_post
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail={"code": "SERVER_ERROR", "message": str(e)}
@@ -143,42 +196,41 @@ def create_post(post: NewPost, db: DBSession):
 
 
 @app.get("/api/posts/{postId}", response_model=Post, tags=["Posts"])
-def get_post(postId: str, db: DBSession):
+async def get_post(postId: str, db: DBSession):
     """Get a single post by ID."""
-    post = db.query(DBPost).filter(DBPost.id == postId).first()
+    post = await db.get(DBPost, postId)
     if not post:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
-            detail={"code": "NOT_FOUND", "message": "Post not found"}
+            detail=POST_NOT_FOUND
         )
     return post
 
 
 @app.patch("/api/posts/{postId}", response_model=Post, tags=["Posts"])
-def update_post(postId: str, post_update: UpdatePost, db: DBSession):
+async def update_post(postId: str, post_update: UpdatePost, db: DBSession):
     """Update an existing post."""
-    post = db.query(DBPost).filter(DBPost.id == postId).first()
+    post = await db.get(DBPost, postId)
     if not post:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
-            detail={"code": "NOT_FOUND", "message": "Post not found"}
+            detail=POST_NOT_FOUND
         )
     
     if not post_update.username or not post_update.content:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail={"code": "BAD_REQUEST", "message": "Invalid input for required fields."}
+            detail=INVALID_FIELDS
         )
     
     try:
         post.username = post_update.username
         post.content = post_update.content
-        post.updatedAt = datetime.utcnow()
-        db.commit()
-        db.refresh(post)
+        await db.commit()
+        await db.refresh(post)
         return post
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail={"code": "SERVER_ERROR", "message": str(e)}
@@ -186,21 +238,21 @@ def update_post(postId: str, post_update: UpdatePost, db: DBSession):
 
 
 @app.delete("/api/posts/{postId}", status_code=status.HTTP_204_NO_CONTENT, tags=["Posts"])
-def delete_post(postId: str, db: DBSession):
+async def delete_post(postId: str, db: DBSession):
     """Delete a post by ID."""
-    post = db.query(DBPost).filter(DBPost.id == postId).first()
+    post = await db.get(DBPost, postId)
     if not post:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
-            detail={"code": "NOT_FOUND", "message": "Post not found"}
+            detail=POST_NOT_FOUND
         )
     
     try:
-        db.delete(post)
-        db.commit()
+        await db.delete(post)
+        await db.commit()
         return Response(status_code=status.HTTP_204_NO_CONTENT)
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail={"code": "SERVER_ERROR", "message": str(e)}
@@ -210,18 +262,18 @@ def delete_post(postId: str, db: DBSession):
 # ==================== COMMENT ENDPOINTS ====================
 
 @app.get("/api/posts/{postId}/comments", response_model=list[Comment], tags=["Comments"])
-def list_comments(postId: str, db: DBSession):
+async def list_comments(postId: str, db: DBSession):
     """List all comments for a post."""
-    post = db.query(DBPost).filter(DBPost.id == postId).first()
+    post = await db.get(DBPost, postId)
     if not post:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
-            detail={"code": "NOT_FOUND", "message": "Post not found"}
+            detail=POST_NOT_FOUND
         )
     
     try:
-        comments = db.query(DBComment).filter(DBComment.postId == postId).all()
-        return comments
+        comments = (await db.scalars(select(DBComment).where(DBComment.postId == postId))).all()
+        return json_list_response(COMMENTS_ADAPTER, comments)
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -230,33 +282,31 @@ def list_comments(postId: str, db: DBSession):
 
 
 @app.post("/api/posts/{postId}/comments", response_model=Comment, status_code=status.HTTP_201_CREATED, tags=["Comments"])
-def create_comment(postId: str, comment: NewComment, db: DBSession):
+async def create_comment(postId: str, comment: NewComment, db: DBSession):
     """Create a new comment on a post."""
-    post = db.query(DBPost).filter(DBPost.id == postId).first()
-    if not post:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail={"code": "NOT_FOUND", "message": "Post not found"}
-        )
-    
     if not comment.username or not comment.content:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail={"code": "BAD_REQUEST", "message": "Invalid input for required fields."}
+            detail=INVALID_FIELDS
         )
     
     try:
-        db_comment = DBComment(
-            postId=postId,
-            username=comment.username,
-            content=comment.content
+        db_comment = await db.scalar(
+            insert(DBComment)
+            .values(postId=postId, username=comment.username, content=comment.content)
+            .returning(DBComment)
         )
-        db.add(db_comment)
-        db.commit()
-        db.refresh(db_comment)
+        await db.commit()
         return db_comment
+    except IntegrityError:
+        await db.rollback()
+        # The post foreign key rejected the insert
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=POST_NOT_FOUND
+        )
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail={"code": "SERVER_ERROR", "message": str(e)}
@@ -264,48 +314,41 @@ def create_comment(postId: str, comment: NewComment, db: DBSession):
 
 
 @app.get("/api/posts/{postId}/comments/{commentId}", response_model=Comment, tags=["Comments"])
-def get_comment(postId: str, commentId: str, db: DBSession):
+async def get_comment(postId: str, commentId: str, db: DBSession):
     """Get a specific comment."""
-    comment = db.query(DBComment).filter(
-        DBComment.id == commentId,
-        DBComment.postId == postId
-    ).first()
-    if not comment:
+    comment = await db.get(DBComment, commentId)
+    if not comment or comment.postId != postId:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
-            detail={"code": "NOT_FOUND", "message": "Comment not found"}
+            detail=COMMENT_NOT_FOUND
         )
     return comment
 
 
 @app.patch("/api/posts/{postId}/comments/{commentId}", response_model=Comment, tags=["Comments"])
-def update_comment(postId: str, commentId: str, comment_update: UpdateComment, db: DBSession):
+async def update_comment(postId: str, commentId: str, comment_update: UpdateComment, db: DBSession):
     """Update an existing comment."""
-    comment = db.query(DBComment).filter(
-        DBComment.id == commentId,
-        DBComment.postId == postId
-    ).first()
-    if not comment:
+    comment = await db.get(DBComment, commentId)
+    if not comment or comment.postId != postId:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
-            detail={"code": "NOT_FOUND", "message": "Comment not found"}
+            detail=COMMENT_NOT_FOUND
         )
     
     if not comment_update.username or not comment_update.content:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail={"code": "BAD_REQUEST", "message": "Invalid input for required fields."}
+            detail=INVALID_FIELDS
         )
     
     try:
         comment.username = comment_update.username
         comment.content = comment_update.content
-        comment.updatedAt = datetime.utcnow()
-        db.commit()
-        db.refresh(comment)
+        await db.commit()
+        await db.refresh(comment)
         return comment
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail={"code": "SERVER_ERROR", "message": str(e)}
@@ -313,24 +356,21 @@ def update_comment(postId: str, commentId: str, comment_update: UpdateComment, d
 
 
 @app.delete("/api/posts/{postId}/comments/{commentId}", status_code=status.HTTP_204_NO_CONTENT, tags=["Comments"])
-def delete_comment(postId: str, commentId: str, db: DBSession):
+async def delete_comment(postId: str, commentId: str, db: DBSession):
     """Delete a comment."""
-    comment = db.query(DBComment).filter(
-        DBComment.id == commentId,
-        DBComment.postId == postId
-    ).first()
-    if not comment:
+    comment = await db.get(DBComment, commentId)
+    if not comment or comment.postId != postId:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
-            detail={"code": "NOT_FOUND", "message": "Comment not found"}
+            detail=COMMENT_NOT_FOUND
         )
     
     try:
-        db.delete(comment)
-        db.commit()
+        await db.delete(comment)
+        await db.commit()
         return Response(status_code=status.HTTP_204_NO_CONTENT)
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail={"code": "SERVER_ERROR", "message": str(e)}
@@ -340,47 +380,50 @@ def delete_comment(postId: str, commentId: str, db: DBSession):
 # ==================== LIKE ENDPOINTS ====================
 
 @app.post("/api/posts/{postId}/likes", response_model=Post, tags=["Likes"])
-def like_post(postId: str, like_request: LikeRequest, db: DBSession):
+async def like_post(postId: str, like_request: LikeRequest, db: DBSession):
     """Like a post."""
-    post = db.query(DBPost).filter(DBPost.id == postId).first()
-    if not post:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail={"code": "NOT_FOUND", "message": "Post not found"}
-        )
-    
     if not like_request.username:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail={"code": "BAD_REQUEST", "message": "Invalid input for required field 'username'."}
+            detail=INVALID_USERNAME
         )
     
     try:
-        # Check if already liked
-        existing_like = db.query(DBLike).filter(
-            DBLike.postId == postId,
-            DBLike.username == like_request.username
-        ).first()
-        
-        if not existing_like:
-            # Create new like
-            db_like = DBLike(
-                postId=postId,
-                username=like_request.username
+        db_like = DBLike(
+            postId=postId,
+            username=like_request.username
+        )
+        db.add(db_like)
+        await db.flush()
+    except IntegrityError:
+        await db.rollback()
+        # Either the post doesn't exist or it's already liked
+        post = await db.get(DBPost, postId)
+        if not post:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=POST_NOT_FOUND
             )
-            db.add(db_like)
-            post.likes += 1
-            db.commit()
-            db.refresh(post)
-        
         return post
-    except IntegrityError:
-        db.rollback()
-        # Already liked, just return the post
-        db.refresh(post)
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail={"code": "SERVER_ERROR", "message": str(e)}
+        )
+    
+    try:
+        result = await db.execute(
+            update(DBPost)
+            .where(DBPost.id == postId)
+            .values(likes=DBPost.likes + 1)
+            .returning(DBPost)
+        )
+        post = result.scalar_one()
+        await db.commit()
         return post
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail={"code": "SERVER_ERROR", "message": str(e)}
@@ -388,41 +431,45 @@ def like_post(postId: str, like_request: LikeRequest, db: DBSession):
 
 
 @app.delete("/api/posts/{postId}/likes", response_model=Post, tags=["Likes"])
-def unlike_post(postId: str, like_request: LikeRequest, db: DBSession):
+async def unlike_post(postId: str, like_request: LikeRequest, db: DBSession):
     """Unlike a post."""
-    post = db.query(DBPost).filter(DBPost.id == postId).first()
-    if not post:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail={"code": "NOT_FOUND", "message": "Post not found"}
-        )
-    
     if not like_request.username:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail={"code": "BAD_REQUEST", "message": "Invalid input for required field 'username'."}
+            detail=INVALID_USERNAME
         )
     
     try:
-        # Find and delete the like
-        like = db.query(DBLike).filter(
-            DBLike.postId == postId,
-            DBLike.username == like_request.username
-        ).first()
-        
-        if like:
-            db.delete(like)
-            post.likes = max(0, post.likes - 1)
-            db.commit()
-            db.refresh(post)
-        
-        return post
+        # Delete the like and only touch the counter if one was removed
+        result = await db.execute(
+            delete(DBLike)
+            .where(DBLike.postId == postId, DBLike.username == like_request.username)
+            .returning(DBLike.id)
+        )
+        if result.first() is not None:
+            result = await db.execute(
+                update(DBPost)
+                .where(DBPost.id == postId)
+                .values(likes=case((DBPost.likes > 0, DBPost.likes - 1), else_=0))
+                .returning(DBPost)
+            )
+            post = result.scalar_one()
+        else:
+            post = await db.get(DBPost, postId)
+        await db.commit()
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail={"code": "SERVER_ERROR", "message": str(e)}
         )
+    
+    if not post:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=POST_NOT_FOUND
+        )
+    return post
 
 
 if __name__ == "__main__":
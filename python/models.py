@@ -1,16 +1,18 @@
-from datetime import datetime
-from sqlalchemy import Column, String, Integer, DateTime, ForeignKey, UniqueConstraint
+from sqlalchemy import Column, String, Integer, DateTime, ForeignKey, UniqueConstraint, func
 from sqlalchemy.orm import relationship
 from database import Base
 import secrets
-import string
+
+
+def utc_now():
+    """SQL expression for the current UTC time, in the microsecond format SQLAlchemy stores."""
+    # CURRENT_TIMESTAMP only has whole seconds; %f gives milliseconds, padded to 6 digits
+    return func.strftime("%Y-%m-%d %H:%M:%f", "now").concat("000")
 
 
 def generate_id(prefix: str) -> str:
     """Generate a random ID with the given prefix."""
-    chars = string.ascii_letters + string.digits + "_-"
-    random_part = ''.join(secrets.choice(chars) for _ in range(8))
-    return f"{prefix}_{random_part}"
+    return f"{prefix}_{secrets.token_urlsafe(6)}"
 
 
 class Post(Base):
@@ -19,8 +21,8 @@ class Post(Base):
     id = Column(String, primary_key=True, default=lambda: generate_id("p"))
     username = Column(String, nullable=False)
     content = Column(String, nullable=False)
-    createdAt = Column(DateTime, nullable=False, default=datetime.utcnow)
-    updatedAt = Column(DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+    createdAt = Column(DateTime, nullable=False, default=utc_now())
+    updatedAt = Column(DateTime, nullable=False, default=utc_now(), onupdate=utc_now())
     likes = Column(Integer, nullable=False, default=0)
 
     comments = relationship("Comment", back_populates="post", cascade="all, delete-orphan")
@@ -31,11 +33,11 @@ class Comment(Base):
     __tablename__ = "comments"
 
     id = Column(String, primary_key=True, default=lambda: generate_id("c"))
-    postId = Column(String, ForeignKey("posts.id"), nullable=False)
+    postId = Column(String, ForeignKey("posts.id"), nullable=False, index=True)
     username = Column(String, nullable=False)
     content = Column(String, nullable=False)
-    createdAt = Column(DateTime, nullable=False, default=datetime.utcnow)
-    updatedAt = Column(DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+    createdAt = Column(DateTime, nullable=False, default=utc_now())
+    updatedAt = Column(DateTime, nullable=False, default=utc_now(), onupdate=utc_now())
 
     post = relationship("Post", back_populates="comments")
 
@@ -46,7 +48,7 @@ class Like(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     postId = Column(String, ForeignKey("posts.id"), nullable=False)
     username = Column(String, nullable=False)
-    createdAt = Column(DateTime, nullable=False, default=datetime.utcnow)
+    createdAt = Column(DateTime, nullable=False, default=utc_now())
 
     post = relationship("Post", back_populates="liked_by")
 